@@ -1,17 +1,17 @@
-import Jetson.GPIO as GPIO
 import time
 
-PIN = 37  # jetson board pin number
+import gpio
 
-GPIO.setmode(GPIO.BOARD)
-GPIO.setup(PIN, GPIO.IN)
+PIN = "PY.02"  # jetson board pin 37
+
+btn = gpio.setup_in(PIN, "button_test")
 
 print("Press the button repeatedly\n")
 
 try:
     while True:
-        raw = GPIO.input(PIN)
+        raw = btn.get_value()
         print("Raw:", raw)
         time.sleep(0.1)
 except KeyboardInterrupt:
-    GPIO.cleanup()
+    gpio.cleanup(btn)
@@ -0,0 +1,130 @@
+"""
+Shared memory region used to pass the side street detection flag from yolo_detect.py to traffic_controller.py.
+Replaces the old temp file + rename handoff, so publishing and reading a result is a plain memory store/load.
+
+The detector also signals an eventfd whenever the flag changes, so the controller can sleep until then.
+The eventfd is handed to the controller over a unix socket, since the two processes aren't related.
+
+Layout:
+    bytes 0-7  sequence number, bumped on every write so the reader can tell a live detector from a dead one
+    byte  8    1 if a vehicle is currently detected, 0 otherwise
+"""
+
+import grp
+import os
+import socket
+import struct
+import threading
+from multiprocessing import shared_memory, resource_tracker
+
+SHM_NAME = "side_detected"
+SHM_SIZE = 16
+# Controller usually runs as root and the detector as the desktop user, so the region is shared
+# through a dedicated group. Anyone else writing the flag could drive the lights, so no world access
+GROUP = "ai-intersection"
+SHM_MODE = 0o660
+
+SEQ = struct.Struct("<Q")
+FLAG_OFFSET = 8
+
+# Private to GROUP (mode 2770, see the README), so nobody else can bind the socket the controller connects to
+RUN_DIR = "/run/ai-intersection"
+WAKE_SOCK_PATH = os.path.join(RUN_DIR, "side_detected.sock")
+WAKE_SOCK_MODE = 0o660
+WAKE_TIMEOUT = 0.2  # The controller fetches the eventfd on its event loop, never block it longer than this
+
+def _group_id():
+    try:
+        return grp.getgrnam(GROUP).gr_gid
+    except KeyError:
+        raise PermissionError(f"group {GROUP} does not exist") from None
+
+def open_region():
+    """
+    Creates the region, or attaches to it if the other process got there first,
+    so the detector and controller can be started in either order.
+    Raises PermissionError if GROUP is missing, we can't open the region,
+    or the existing region isn't restricted to GROUP.
+    """
+    gid = _group_id()
+    try:
+        shm = shared_memory.SharedMemory(name=SHM_NAME, create=True, size=SHM_SIZE)
+    except FileExistsError:
+        shm = shared_memory.SharedMemory(name=SHM_NAME)
+        st = os.fstat(shm._fd)
+        if st.st_gid != gid or st.st_mode & 0o007:
+            # Left by an older version or created by someone else, either way not ours to trust
+            shm.close()
+            raise PermissionError(f"/dev/shm/{SHM_NAME} is not restricted to group {GROUP}")
+    else:
+        try:
+            os.fchown(shm._fd, -1, gid)
+            os.fchmod(shm._fd, SHM_MODE)
+        except OSError:
+            # Don't leave a region the other process can't open
+            shm.close()
+            shm.unlink()
+            raise
+
+    # The region is shared by both processes, so neither should unlink it when it exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def write_flag(shm, detected):
+    buf = shm.buf
+    buf[FLAG_OFFSET] = 1 if detected else 0
+    seq = SEQ.unpack_from(buf, 0)[0]
+    SEQ.pack_into(buf, 0, seq + 1)
+
+def read_flag(shm):
+    """Returns (sequence number, detected)."""
+    buf = shm.buf
+    return SEQ.unpack_from(buf, 0)[0], buf[FLAG_OFFSET] == 1
+
+def create_wakeup():
+    """
+    Creates the eventfd the detector signals on each change, and starts a thread
+    that hands it to any controller connecting to WAKE_SOCK_PATH.
+    """
+    efd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+
+    try:
+        os.unlink(WAKE_SOCK_PATH)
+    except FileNotFoundError:
+        pass
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.bind(WAKE_SOCK_PATH)
+    os.chmod(WAKE_SOCK_PATH, WAKE_SOCK_MODE)
+    srv.listen()
+
+    threading.Thread(target=_serve_wakeup, args=(srv, efd), daemon=True).start()
+    return efd
+
+def _serve_wakeup(srv, efd):
+    while True:
+        conn, _ = srv.accept()
+        with conn:
+            try:
+                socket.send_fds(conn, [b"e"], [efd])
+            except OSError:
+                pass # Controller went away mid-handoff, it will reconnect
+
+def close_wakeup(efd):
+    try:
+        os.unlink(WAKE_SOCK_PATH)
+    except FileNotFoundError:
+        pass
+    os.close(efd)
+
+def fetch_wakeup():
+    """
+    Returns the detector's eventfd, raises OSError if the detector isn't serving one
+    or doesn't answer within WAKE_TIMEOUT (socket.timeout is an OSError).
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(WAKE_TIMEOUT)
+        sock.connect(WAKE_SOCK_PATH)
+        _, fds, _, _ = socket.recv_fds(sock, 1, 1)
+    if not fds:
+        raise OSError("detector did not send an eventfd")
+    return fds[0]
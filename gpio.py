@@ -0,0 +1,66 @@
+"""
+Thin libgpiod wrapper shared by the controller and the hardware test scripts.
+A pin is either a line offset on CHIP (int) or a tegra234 line name such as "PN.01" (str).
+Names are resolved on CHIP too, so every line comes from the one chip handle (a bulk request
+needs all its lines on the same handle). See the README for the 40-pin header BOARD pin -> line name table.
+"""
+
+import gpiod
+
+# gpio chip for jetson orin nano super (tegra234-gpio, every header pin we use is on it)
+CHIP = "/dev/gpiochip4"
+
+_chip = None
+
+def _get_chip():
+    global _chip
+    if _chip is None:
+        _chip = gpiod.Chip(CHIP)
+    return _chip
+
+def _get_offset(line):
+    if isinstance(line, str):
+        found = _get_chip().find_line(line)
+        if found is None:
+            raise OSError(f"GPIO line {line} not found on {CHIP}")
+        return found.offset()
+    return line
+
+def _get_line(line):
+    return _get_chip().get_line(_get_offset(line))
+
+def _get_lines(lines):
+    return _get_chip().get_lines([_get_offset(line) for line in lines])
+
+def setup_out(lines, consumer):
+    """
+    Requests output lines as one bulk, all starting low.
+    Returns the bulk so set_values can change every line in a single call.
+    """
+    bulk = _get_lines(lines)
+    bulk.request(consumer=consumer, type=gpiod.LINE_REQ_DIR_OUT, default_vals=[0] * len(lines))
+    return bulk
+
+def setup_in(line, consumer):
+    """Requests a plain input line, for scripts that poll get_value()."""
+    pin = _get_line(line)
+    pin.request(consumer=consumer, type=gpiod.LINE_REQ_DIR_IN)
+    return pin
+
+def setup_in_edge(line, consumer):
+    """
+    Requests an input line with both-edge events.
+    The returned line's event_get_fd() becomes readable on each edge, get_value() still reads the level.
+    """
+    pin = _get_line(line)
+    pin.request(consumer=consumer, type=gpiod.LINE_REQ_EV_BOTH_EDGES)
+    return pin
+
+def cleanup(*requests):
+    """Releases the given line requests and closes the chip."""
+    global _chip
+    for request in requests:
+        request.release()
+    if _chip is not None:
+        _chip.close()
+        _chip = None
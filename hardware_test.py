@@ -1,9 +1,7 @@
-import gpiod
 import time
-# pin setup
 
-#gpio chip for jetson orin nano super
-CHIP = "/dev/gpiochip4"
+import gpio
+# pin setup (line offsets on gpio.CHIP)
 
 #led pins
 SIDE_R = 100
@@ -17,33 +15,36 @@ MAIN_G = 105
 # button pin
 BUTTON = 77
 
+# button is sampled every 5ms and only changes state once the last 16 samples agree
+DEBOUNCE_INTERVAL = 0.005
+DEBOUNCE_MASK = 0xFFFF
+
 LED_LINES = [SIDE_R, SIDE_Y, SIDE_G, MAIN_R, MAIN_Y, MAIN_G]
 
 # init gpio
-chip = gpiod.Chip(CHIP)
 
+#outputs, requested together so each pattern is one set_values call
+leds = gpio.setup_out(LED_LINES, "led_test")
 
-#outputs
-leds = [chip.get_line(pin) for pin in LED_LINES]
-for line in leds:
-	line.request(consumer="led_test", type=gpiod.LINE_REQ_DIR_OUT, default_vals=[0])
+# one LED on at a time, in LED_LINES order
+patterns = [[1 if j == i else 0 for j in range(len(LED_LINES))] for i in range(len(LED_LINES))]
+all_off = [0] * len(LED_LINES)
 
 # input with internal pull down disabled
-btn = chip.get_line(BUTTON)
-btn.request(consumer="button_test", type=gpiod.LINE_REQ_DIR_IN)
+btn = gpio.setup_in(BUTTON, "button_test")
 
 
 print("Starting LED Test...")
 time.sleep(1)
 
 # led test
-for pin in zip(LED_LINES, leds):
+for pin, pattern in zip(LED_LINES, patterns):
 	print(f"Testing LED on pin {pin} - ON")
-	line.set_value(1)
+	leds.set_values(pattern)
 	time.sleep(1)
 
-	print(f"Testing LED on pin {pin} = OFF")
-	line.set_value(0)
+	print(f"Testing LED on pin {pin} - OFF")
+	leds.set_values(all_off)
 	time.sleep(0.3)
 
 print("\nLED test complete.\n")
@@ -53,15 +54,22 @@ print("Starting button test.")
 print("Press the button to see state changes...")
 print("CTRL+C to exit.\n")
 
+btn_hist = 0
+pressed = False
+
 try:
 	while True:
-		val = btn.get_value()
-		if val == 1:
+		btn_hist = ((btn_hist << 1) | btn.get_value()) & DEBOUNCE_MASK
+
+		if btn_hist == DEBOUNCE_MASK and not pressed:
+			pressed = True
 			print("Button: Pressed")
-		else:
+		elif btn_hist == 0 and pressed:
+			pressed = False
 			print("Button: not pressed")
 
-		time.sleep(0.2)
+		time.sleep(DEBOUNCE_INTERVAL)
 
 except KeyboardInterrupt:
 	print("\nExiting...")
+	gpio.cleanup(leds, btn)
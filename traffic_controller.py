@@ -1,18 +1,29 @@
 #!/usr/bin/env python3
 import time
 import os
-import Jetson.GPIO as GPIO
+import asyncio
+import ctypes
+from enum import IntEnum
 
-# Pin config
-PIN_MAIN_R = 15
-PIN_MAIN_Y = 16
-PIN_MAIN_G = 13
+import detection_shm
+import gpio
 
-PIN_SIDE_R = 7
-PIN_SIDE_Y = 11  
-PIN_SIDE_G = 12 
+# Optional, lets the shared file fallback wake on changes instead of being polled
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
-PIN_BUTTON = 22
+# Pin config (tegra234 line names, see the README for the BOARD pin mapping)
+PIN_MAIN_R = "PN.01" # BOARD 15
+PIN_MAIN_Y = "PY.04" # BOARD 16
+PIN_MAIN_G = "PY.00" # BOARD 13
+
+PIN_SIDE_R = "PAC.06" # BOARD 7
+PIN_SIDE_Y = "PR.04"  # BOARD 11
+PIN_SIDE_G = "PH.07"  # BOARD 12
+
+BUTTON_LINE = "PY.01" # BOARD 22
 
 # Timing parameters
 MIN_MAIN_GREEN   = 5.0  # Minimum time main stays green before it can change
@@ -28,169 +39,444 @@ SIDE_MAX_GREEN   = 15.0 # Absolute max time for side street
 SIDE_GAP_TIME    = 2.5  # How long car must be gone before light turns yellow
 DETECTION_DELAY  = 1.0  # How long car must be seen before requesting light
 
-# temporary file location for reading state of vehicles
+# How often the YOLO flag is sampled for changes when the detector can't wake us
+POLL_INTERVAL    = 0.05
+
+# Button debounce: after an edge, sample every DEBOUNCE_INTERVAL until the last 16 samples agree
+DEBOUNCE_INTERVAL = 0.001
+DEBOUNCE_MASK     = 0xFFFF
+
+# Real-time scheduling, needs root or CAP_SYS_NICE (falls back to normal scheduling otherwise)
+RT_PRIORITY = 50
+RT_CPU      = 3  # Add isolcpus=3 to the kernel cmdline to keep everything else off this core
+
+# mlockall flags from <sys/mman.h>
+MCL_CURRENT = 1
+MCL_FUTURE  = 2
+
+# temporary file location for reading state of vehicles, only used if shared memory is unavailable
 YOLO_FLAG_PATH = "/tmp/side_detected.txt"
+YOLO_STALE_TIME  = 1.0  # Treat detector as offline if it hasn't published for this long, also the liveness check interval
 
-# gpio setup
-GPIO.setmode(GPIO.BOARD)
-GPIO.setwarnings(False)
+# Controller states, values index the LIGHT_PATTERNS and STATE_HANDLERS tuples
+class S(IntEnum):
+    MAIN_GREEN  = 0
+    MAIN_YELLOW = 1
+    ALL_RED_1   = 2
+    SIDE_GREEN  = 3
+    SIDE_YELLOW = 4
+    ALL_RED_2   = 5
+
+# Light outputs for each state, in output_pins order: (main R, Y, G, side R, Y, G)
+LIGHT_PATTERNS = (
+    (0, 0, 1, 1, 0, 0), # MAIN_GREEN
+    (0, 1, 0, 1, 0, 0), # MAIN_YELLOW
+    (1, 0, 0, 1, 0, 0), # ALL_RED_1
+    (1, 0, 0, 0, 0, 1), # SIDE_GREEN
+    (1, 0, 0, 0, 1, 0), # SIDE_YELLOW
+    (1, 0, 0, 1, 0, 0), # ALL_RED_2
+)
+LIGHTS_OFF = (0, 0, 0, 0, 0, 0)
+assert len(LIGHT_PATTERNS) == len(S)
 
+# Time each state must run before it can end, used to set state_deadline on entry
+STATE_DURATIONS = (
+    MIN_MAIN_GREEN,   # MAIN_GREEN
+    MAIN_YELLOW_TIME, # MAIN_YELLOW
+    ALL_RED_TIME,     # ALL_RED_1
+    SIDE_MIN_GREEN,   # SIDE_GREEN, extended to SIDE_PED_TIME for pedestrians
+    MAIN_YELLOW_TIME, # SIDE_YELLOW
+    ALL_RED_TIME,     # ALL_RED_2
+)
+assert len(STATE_DURATIONS) == len(S)
+
+# gpio setup
+# Lights are requested as one bulk so every change is a single ioctl with no visible intermediate state
 output_pins = [PIN_MAIN_R, PIN_MAIN_Y, PIN_MAIN_G, PIN_SIDE_R, PIN_SIDE_Y, PIN_SIDE_G]
-for p in output_pins:
-    GPIO.setup(p, GPIO.OUT)
-    GPIO.output(p, GPIO.LOW)
+light_lines = gpio.setup_out(output_pins, "traffic_controller")
 
-# Button setup
-GPIO.setup(PIN_BUTTON, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+# Button setup, kernel queues an event on each edge so we can sleep until one arrives
+btn = gpio.setup_in_edge(BUTTON_LINE, "traffic_controller")
 
 # Global flags
 req_pedestrian = False 
 req_car = False        
 
-# Function to set all lights at once
-def set_lights(mr, my, mg, sr, sy, sg):
-    GPIO.output(PIN_MAIN_R, mr)
-    GPIO.output(PIN_MAIN_Y, my)
-    GPIO.output(PIN_MAIN_G, mg)
-    GPIO.output(PIN_SIDE_R, sr)
-    GPIO.output(PIN_SIDE_Y, sy)
-    GPIO.output(PIN_SIDE_G, sg)
+# State timing, deadlines are absolute time.monotonic() values set on each transition
+state_start_time = 0.0
+state_deadline = 0.0
 
-# Reads the shared file to see if object is currently visible
+# Tracking variables for detection filtering
+car_present = False
+car_confirm_deadline = None # When a car that is still present counts as a stable detection
+car_gap_deadline = 0.0      # When the side street has been clear for SIDE_GAP_TIME
+last_car_seen_time = 0.0
+
+# Shared memory state for YOLO detection
+yolo_shm = None
+yolo_seq = None
+yolo_seq_time = 0.0
+yolo_online = False
+yolo_wake_fd = None # Detector's eventfd, signalled when the flag changes
+
+# Shared file fallback, kept open and read with pread
+yolo_flag_fd = None
+yolo_flag_watch = None
+
+# Function to set all lights at once from a pattern tuple
+def set_lights(pattern):
+    light_lines.set_values(pattern)
+
+# Shows the light pattern for a state
+def apply_lights(state):
+    set_lights(LIGHT_PATTERNS[state])
+
+# Shifts the latest button sample into the debounce history
+def debounce(hist, sample):
+    return ((hist << 1) | sample) & DEBOUNCE_MASK
+
+# Runs the controller as a SCHED_FIFO task pinned to RT_CPU with its memory locked,
+# so other processes (like YOLO) can't delay light transitions
+def set_realtime():
+    try:
+        os.sched_setaffinity(0, {RT_CPU})
+    except OSError as e:
+        print(f"[WARN] Could not pin to CPU {RT_CPU} ({e})")
+
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(RT_PRIORITY))
+    except OSError as e:
+        print(f"[WARN] Could not enable SCHED_FIFO ({e}), running with normal priority")
+
+    # Avoid page faults in the loop
+    libc = ctypes.CDLL("libc.so.6", use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        print(f"[WARN] Could not lock memory ({os.strerror(ctypes.get_errno())})")
+
+# Attaches to the detector's shared memory region, opens the shared file instead if that fails
+def open_yolo_source():
+    global yolo_shm, yolo_flag_watch, yolo_seq, yolo_seq_time, yolo_online
+    try:
+        yolo_shm = detection_shm.open_region()
+    except OSError as e:
+        print(f"[WARN] Shared memory unavailable ({e}), falling back to {YOLO_FLAG_PATH}")
+        # The file is opened on first read, it may not exist until the detector writes it
+        # The detector renames each update into place, so watch the directory for moves
+        if inotify_simple is not None:
+            yolo_flag_watch = inotify_simple.INotify()
+            yolo_flag_watch.add_watch(os.path.dirname(YOLO_FLAG_PATH), inotify_simple.flags.MOVED_TO)
+        return
+
+    # The region outlives the detector, so whatever it holds now may be left over from a dead one.
+    # Only trust the flag once the detector publishes past this sequence number
+    yolo_seq, _ = detection_shm.read_flag(yolo_shm)
+    yolo_seq_time = time.monotonic()
+    yolo_online = False
+
+# Reads shared memory to see if object is currently visible
 def read_yolo_car_present():
-    if not os.path.exists(YOLO_FLAG_PATH):
+    global yolo_seq, yolo_seq_time, yolo_online
+    if yolo_shm is None:
+        return read_yolo_flag_file()
+
+    seq, detected = detection_shm.read_flag(yolo_shm)
+    now = time.monotonic()
+    if seq != yolo_seq:
+        yolo_seq = seq
+        yolo_seq_time = now
+        yolo_online = True
+    elif now - yolo_seq_time >= YOLO_STALE_TIME:
+        # Detector stopped publishing
+        yolo_online = False
+
+    # Don't trust a stale flag
+    if not yolo_online:
         return False
+    return detected
+
+# Reads the shared file to see if object is currently visible
+def read_yolo_flag_file():
+    global yolo_flag_fd
     try:
-        with open(YOLO_FLAG_PATH, "r") as f:
-            val = f.read().strip()
-            return val == "1"
-    except (IOError, ValueError):
+        # Never create the file here, a root-owned file in sticky /tmp would stop the detector replacing it
+        if yolo_flag_fd is None:
+            yolo_flag_fd = os.open(YOLO_FLAG_PATH, os.O_RDONLY)
+
+        # The detector replaces the file atomically, so reopen once our copy has been unlinked
+        elif os.fstat(yolo_flag_fd).st_nlink == 0:
+            fd = os.open(YOLO_FLAG_PATH, os.O_RDONLY)
+            os.close(yolo_flag_fd)
+            yolo_flag_fd = fd
+        return os.pread(yolo_flag_fd, 1, 0) == b"1"
+    except OSError:
         return False
 
-# Main loop
-def main():
+# State handlers: each takes the current time and returns the next state
+
+def handle_main_green(now):
+    # Change if Request Exists and min green time satisfied
+    if (req_pedestrian or req_car) and now >= state_deadline:
+        print(f"[STATE] Switching to MAIN_YELLOW. (Ped: {req_pedestrian}, Car: {req_car})")
+        return S.MAIN_YELLOW
+    return S.MAIN_GREEN
+
+def handle_main_yellow(now):
+    if now >= state_deadline:
+        return S.ALL_RED_1
+    return S.MAIN_YELLOW
+
+def handle_all_red_1(now):
+    # Safety barrier before side turns Green
+    if now >= state_deadline:
+        print("[STATE] SIDE_GREEN")
+        return S.SIDE_GREEN
+    return S.ALL_RED_1
+
+# End of the minimum side green, pedestrians get longer to cross
+def side_min_deadline():
+    return state_start_time + SIDE_PED_TIME if req_pedestrian else state_deadline
+
+def handle_side_green(now):
     global req_pedestrian, req_car
+    time_to_close = False
     
-    state = "MAIN_GREEN"
-    state_start_time = time.time()
+    # Hold the light if min time not met, or a car is present or was seen less than GAP_TIME ago
+    hold_for_min_time = (now < side_min_deadline())
+    hold_for_car_gap  = car_present or (now < car_gap_deadline)
     
-    # Tracking variables for detection filtering
-    car_first_seen_time = None 
-    last_car_seen_time = 0.0   
+    # If neither hold condition is true, we can close
+    if not hold_for_min_time and not hold_for_car_gap:
+        time_to_close = True
+
+    # Max green safety override
+    if now >= state_start_time + SIDE_MAX_GREEN:
+        print("[INFO] Max Green Reached - Forcing Change")
+        time_to_close = True
+
+    if time_to_close:
+        gap = 0.0 if car_present else now - last_car_seen_time
+        print(f"[STATE] Switching to SIDE_YELLOW (Gap: {gap:.1f}s)")
+        
+        # Reset requests
+        req_pedestrian = False
+        req_car = False
+        return S.SIDE_YELLOW
+    return S.SIDE_GREEN
+
+def handle_side_yellow(now):
+    if now >= state_deadline:
+        return S.ALL_RED_2
+    return S.SIDE_YELLOW
+
+def handle_all_red_2(now):
+    # Safety barrier before main turns green
+    if now >= state_deadline:
+        print("[STATE] MAIN_GREEN (Idle)")
+        return S.MAIN_GREEN
+    return S.ALL_RED_2
+
+# Indexed by S
+STATE_HANDLERS = (
+    handle_main_green,
+    handle_main_yellow,
+    handle_all_red_1,
+    handle_side_green,
+    handle_side_yellow,
+    handle_all_red_2,
+)
+assert len(STATE_HANDLERS) == len(S)
+
+# Records a change in YOLO detection, returns True if it changed
+def note_car_present(present, now):
+    global car_present, car_confirm_deadline, car_gap_deadline, last_car_seen_time
+    if present == car_present:
+        return False
+
+    car_present = present
+    if present:
+        car_confirm_deadline = now + DETECTION_DELAY # Start confirm timer
+    else:
+        # Object lost, reset initial detection timer and start the gap timer
+        car_confirm_deadline = None
+        car_gap_deadline = now + SIDE_GAP_TIME
+        last_car_seen_time = now
+    return True
+
+# Returns the next time the state machine needs to run without any input, or None to wait for input
+def next_deadline(state):
+    if state == S.MAIN_GREEN:
+        deadlines = []
+        if req_pedestrian or req_car:
+            deadlines.append(state_deadline)
+        if car_present and not req_car:
+            deadlines.append(car_confirm_deadline)
+        return min(deadlines, default=None)
+
+    if state != S.SIDE_GREEN:
+        return state_deadline
+
+    # SIDE_GREEN holds while a car is present, so only the max green can end it
+    max_deadline = state_start_time + SIDE_MAX_GREEN
+    if car_present:
+        return max_deadline
+    return min(max(side_min_deadline(), car_gap_deadline), max_deadline)
+
+# Debounces the button after each edge and raises the pedestrian request on a stable press
+async def watch_button(edge, wake):
+    global req_pedestrian
+    btn_hist = 0
+    btn_pressed = False
+
+    while True:
+        await edge.wait()
+        edge.clear()
+
+        # Sample until the last 16 samples agree, so bounce can't raise a request
+        while True:
+            btn_hist = debounce(btn_hist, btn.get_value())
+            if btn_hist == DEBOUNCE_MASK:
+                if not btn_pressed:
+                    btn_pressed = True
+                    if not req_pedestrian:
+                        print("[EVENT] Pedestrian Button Pressed")
+                        req_pedestrian = True
+                        wake.set()
+                break
+            elif btn_hist == 0:
+                btn_pressed = False
+                break
+            await asyncio.sleep(DEBOUNCE_INTERVAL)
+
+# Called when the detector signals its eventfd, rereads the shared flag
+def on_yolo_wakeup(wake):
+    os.eventfd_read(yolo_wake_fd) # Drains every signal since the last read
+    if note_car_present(read_yolo_car_present(), time.monotonic()):
+        wake.set()
+
+# Gets the detector's eventfd and wakes on it, returns False if the detector isn't serving one
+def connect_yolo_wakeup(loop, wake):
+    global yolo_wake_fd
+    try:
+        yolo_wake_fd = detection_shm.fetch_wakeup()
+    except OSError:
+        return False
+    loop.add_reader(yolo_wake_fd, on_yolo_wakeup, wake)
+    print("[INFO] Waking on detector changes")
+    return True
+
+def disconnect_yolo_wakeup(loop):
+    global yolo_wake_fd
+    loop.remove_reader(yolo_wake_fd)
+    os.close(yolo_wake_fd)
+    yolo_wake_fd = None
+
+# Samples the YOLO flag and wakes the state machine only when it changes.
+# Once the detector's eventfd wakes us on changes, this only checks the detector is still alive
+async def watch_yolo(loop, wake):
+    while True:
+        if note_car_present(read_yolo_car_present(), time.monotonic()):
+            wake.set()
+
+        if yolo_shm is not None:
+            if yolo_wake_fd is None and yolo_online:
+                connect_yolo_wakeup(loop, wake)
+            elif yolo_wake_fd is not None and not yolo_online:
+                # Detector died, a restarted one serves a new eventfd
+                print("[WARN] Detector offline, polling until it returns")
+                disconnect_yolo_wakeup(loop)
+
+        await asyncio.sleep(POLL_INTERVAL if yolo_wake_fd is None else YOLO_STALE_TIME)
+
+# Called when the watched directory has inotify events, rereads the flag only if the shared file was replaced
+def on_yolo_flag_moved(wake):
+    names = [e.name for e in yolo_flag_watch.read(timeout=0)]
+    if os.path.basename(YOLO_FLAG_PATH) in names:
+        if note_car_present(read_yolo_flag_file(), time.monotonic()):
+            wake.set()
+
+# Main loop
+async def main():
+    global req_car, state_start_time, state_deadline
     
+    set_realtime()
+
+    state = S.MAIN_GREEN
+    state_start_time = time.monotonic()
+    state_deadline = state_start_time + STATE_DURATIONS[state]
+
+    open_yolo_source()
+
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    btn_edge = asyncio.Event()
+
+    # Kernel queues an event on each button edge, drain it and let watch_button debounce
+    def on_button_edge():
+        btn.event_read_multiple()
+        btn_edge.set()
+
+    loop.add_reader(btn.event_get_fd(), on_button_edge)
+    tasks = [asyncio.create_task(watch_button(btn_edge, wake))]
+
+    # Shared file with inotify wakes us on change, anything else is sampled
+    if yolo_flag_watch is not None:
+        note_car_present(read_yolo_flag_file(), time.monotonic())
+        loop.add_reader(yolo_flag_watch.fileno(), on_yolo_flag_moved, wake)
+    else:
+        tasks.append(asyncio.create_task(watch_yolo(loop, wake)))
+
     print("[INFO] Controller Started. Waiting for triggers...")
-    set_lights(0, 0, 1, 1, 0, 0) # Start Main Green
+    apply_lights(state) # Start Main Green
 
     try:
         while True:
-            now = time.time()
-            time_in_state = now - state_start_time
+            wake.clear()
+            now = time.monotonic()
             
             # Input processing
-            
-            # 1. Check Button
-            if GPIO.input(PIN_BUTTON) == GPIO.HIGH:
-                if not req_pedestrian:
-                    print("[EVENT] Pedestrian Button Pressed")
-                    req_pedestrian = True
-
-            # 2. Check YOLO
-            is_car_present = read_yolo_car_present()
-            
-            if is_car_present:
-                # Always record the last time we saw it
-                last_car_seen_time = now
-                
-                # Logic to trigger initial request
-                if car_first_seen_time is None:
-                    car_first_seen_time = now # Start confirm timer
-                elif (now - car_first_seen_time) >= DETECTION_DELAY:
-                    # Object has been stable for > DETECTION_DELAY
-                    if not req_car and state == "MAIN_GREEN":
-                        print("[EVENT] Object Confirmed (Stable Detection)")
-                        req_car = True
-            else:
-                # Object lost, reset initial detection timer
-                car_first_seen_time = None
+            if car_present and now >= car_confirm_deadline:
+                # Object has been stable for > DETECTION_DELAY
+                if not req_car and state == S.MAIN_GREEN:
+                    print("[EVENT] Object Confirmed (Stable Detection)")
+                    req_car = True
 
             # State machine
+            next_state = STATE_HANDLERS[state](now)
+            if next_state != state:
+                state = next_state
+                state_start_time = now
+                state_deadline = now + STATE_DURATIONS[state]
+                apply_lights(state)
 
-            if state == "MAIN_GREEN":
-                # Change if Request Exists and min green time satisfied
-                if (req_pedestrian or req_car) and time_in_state >= MIN_MAIN_GREEN:
-                    print(f"[STATE] Switching to MAIN_YELLOW. (Ped: {req_pedestrian}, Car: {req_car})")
-                    state = "MAIN_YELLOW"
-                    state_start_time = now
-                    set_lights(0, 1, 0, 1, 0, 0)
-
-            elif state == "MAIN_YELLOW":
-                if time_in_state >= MAIN_YELLOW_TIME:
-                    state = "ALL_RED_1"
-                    state_start_time = now
-                    set_lights(1, 0, 0, 1, 0, 0) # All Red
-
-            elif state == "ALL_RED_1":
-                # Safety barrier before side turns Green
-                if time_in_state >= ALL_RED_TIME:
-                    state = "SIDE_GREEN"
-                    state_start_time = now
-                    set_lights(1, 0, 0, 0, 0, 1)
-                    print("[STATE] SIDE_GREEN")
-
-            elif state == "SIDE_GREEN":
-                time_to_close = False
-                
-                # Determine base minimum duration
-                min_duration = SIDE_PED_TIME if req_pedestrian else SIDE_MIN_GREEN
-                
-                # Calculate gap logic
-                time_since_last_car = now - last_car_seen_time
-                
-                # Hold the light if min time not met, or saw a car less than GAP_TIME ago
-                hold_for_min_time = (time_in_state < min_duration)
-                hold_for_car_gap  = (time_since_last_car < SIDE_GAP_TIME)
-                
-                # If neither hold condition is true, we can close
-                if not hold_for_min_time and not hold_for_car_gap:
-                    time_to_close = True
-
-                # Max green safety override
-                if time_in_state >= SIDE_MAX_GREEN:
-                    print("[INFO] Max Green Reached - Forcing Change")
-                    time_to_close = True
-
-                if time_to_close:
-                    print(f"[STATE] Switching to SIDE_YELLOW (Gap: {time_since_last_car:.1f}s)")
-                    state = "SIDE_YELLOW"
-                    state_start_time = now
-                    set_lights(1, 0, 0, 0, 1, 0)
-                    
-                    # Reset requests
-                    req_pedestrian = False
-                    req_car = False
-
-            elif state == "SIDE_YELLOW":
-                if time_in_state >= MAIN_YELLOW_TIME:
-                    state = "ALL_RED_2"
-                    state_start_time = now
-                    set_lights(1, 0, 0, 1, 0, 0) # All Red
-
-            elif state == "ALL_RED_2":
-                # Safety barrier before main turns green
-                if time_in_state >= ALL_RED_TIME:
-                    state = "MAIN_GREEN"
-                    state_start_time = now
-                    set_lights(0, 0, 1, 1, 0, 0)
-                    print("[STATE] MAIN_GREEN (Idle)")
-
-            time.sleep(0.05) 
+            # Sleep until an input changes or the next deadline passes
+            deadline = next_deadline(state)
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                await asyncio.wait_for(wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-    except KeyboardInterrupt:
+    except asyncio.CancelledError:
         print("\n[INFO] Shutdown requested")
     finally:
-        set_lights(0, 0, 0, 0, 0, 0)
-        GPIO.cleanup()
+        loop.remove_reader(btn.event_get_fd())
+        if yolo_flag_watch is not None:
+            loop.remove_reader(yolo_flag_watch.fileno())
+            yolo_flag_watch.close()
+        if yolo_wake_fd is not None:
+            disconnect_yolo_wakeup(loop)
+        for task in tasks:
+            task.cancel()
+        set_lights(LIGHTS_OFF)
+        gpio.cleanup(light_lines, btn)
+        if yolo_shm is not None:
+            yolo_shm.close()
+        if yolo_flag_fd is not None:
+            os.close(yolo_flag_fd)
         print("[INFO] Cleanup Complete")
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -1,100 +1,228 @@
 #!/usr/bin/env python3
 """
-Runs YOLOv8 object detection on webcam. Detects vehicles. Writes '1' to a shared file if detected, '0' otherwise.
-Uses file writing to prevent read-errors in the main controller.
+Runs YOLOv8 object detection on webcam. Detects vehicles. Publishes 1 to shared memory if detected, 0 otherwise.
+Falls back to writing '1'/'0' to a shared file if shared memory is unavailable.
 """
 
 import cv2
-import time
+import numpy as np
 import os
-import tempfile
+import torch
+import queue
+import threading
+import time
 from ultralytics import YOLO
 
+import detection_shm
+
 # Config
-MODEL_PATH = "yolov8n.onnx"
+# TensorRT FP16 engine, build once on the Jetson with:
+#   python -c "from ultralytics import YOLO; YOLO('yolov8n.pt').export(format='engine', half=True, imgsz=640, device=0)"
+MODEL_PATH = "yolov8n.engine"
+FALLBACK_MODEL_PATH = "yolov8n.onnx"  # Uses the CUDA execution provider when onnxruntime-gpu is installed
+IMG_SIZE = 640
+DEVICE = 0
+FALLBACK_DEVICE = DEVICE if torch.cuda.is_available() else "cpu"  # ONNX still runs without CUDA torch
 SHARED_FILE_PATH = "/tmp/side_detected.txt"
+STAGE_FILE_PATH = "/tmp/.side_detected.stage"  # Same filesystem as SHARED_FILE_PATH so the move is atomic
 CONFIDENCE_THRESHOLD = 0.45
 
-# Class IDs for vehicles: 2=car, 3=motorcycle, 5=bus, 7=truck
+# Visualization is off by default, set YOLO_SHOW=1 to show every SHOW_EVERY-th annotated frame
+DISPLAY = os.environ.get("YOLO_SHOW", "0") == "1"
+SHOW_EVERY = 5
+
+# Camera frame rate, the capture thread's blocking cap.read() paces the detection loop
+CAMERA_FPS = 10
+FRAME_TIMEOUT = 1.0  # Give up if the camera delivers nothing for this long
+
+# Frame-diff gate: skip inference while the scene is static, reusing the last result
+DIFF_SIZE = (32, 32)    # Grayscale thumbnail the frames are compared at
+DIFF_THRESHOLD = 4.0    # Mean absolute pixel difference below which a frame counts as unchanged
+MAX_STALE = 2.0         # Run inference at least this often even if the scene looks static
+
+# Class IDs for vehicles: 2=car, 3=motorcycle, 5=bus, 7=truck (passed to the model as its class filter)
 VEHICLE_CLASSES = [2, 3, 5, 7, 46]
 
+# Shared memory region for the detection flag, None if we fell back to the shared file
+status_shm = None
+
+# eventfd signalled when the flag changes, None if unavailable (the controller then polls)
+wake_fd = None
+
+# Last value published, the controller is only woken and the shared file only written when it changes
+last_written = None
+
 def write_status(detected):
     """
-    Writes status to a temp file then moves it to final destination
-    to ensure the main script never reads a half-written file.
+    Publishes status to shared memory. Without shared memory, writes status to a staging
+    file then moves it to final destination to ensure the main script never reads a half-written file.
     """
-    content = "1" if detected else "0"
+    global last_written
+    if status_shm is not None:
+        # Every write bumps the sequence number so the controller knows we're alive,
+        # but it only needs waking when the result changes
+        detection_shm.write_flag(status_shm, detected)
+        if wake_fd is not None and detected != last_written:
+            os.eventfd_write(wake_fd, 1)
+        last_written = detected
+        return
 
-    # Write to a temp file first
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, dir='/tmp') as tmp:
-        tmp.write(content)
-        tmp.flush()
-        os.fsync(tmp.fileno())
-        tmp_name = tmp.name
+    # The file only needs rewriting when detection changes
+    if detected == last_written:
+        return
+
+    # Write to the staging file first
+    fd = os.open(STAGE_FILE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, b"1" if detected else b"0")
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
     # Atomic move
-    os.replace(tmp_name, SHARED_FILE_PATH)
+    os.replace(STAGE_FILE_PATH, SHARED_FILE_PATH)
+    last_written = detected
+
+def grab_frames(cap, frame_slot, stop):
+    """
+    Capture thread. Keeps only the newest frame in frame_slot, dropping the old one,
+    so inference always runs on the freshest frame and never waits on the camera mid-frame.
+    """
+    while not stop.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            print("Failed to grab frame")
+            return
+
+        try:
+            frame_slot.get_nowait()
+        except queue.Empty:
+            pass
+        frame_slot.put(frame)
+
+def load_model():
+    """
+    Loads the TensorRT engine, falling back to ONNX if it can't be used.
+    Returns (model, half, device) where half says whether to run inference in FP16, or (None, False, None) if neither loads.
+    """
+    # Ultralytics only builds the backend on first inference, so run a warmup frame to surface load errors here
+    warmup = np.zeros((IMG_SIZE, IMG_SIZE, 3), dtype=np.uint8)
+
+    for path, half, device in ((MODEL_PATH, True, DEVICE), (FALLBACK_MODEL_PATH, False, FALLBACK_DEVICE)):
+        print(f"Loading model: {path}...")
+        try:
+            model = YOLO(path, task='detect')
+            model(warmup, verbose=False, imgsz=IMG_SIZE, half=half, device=device)
+            return model, half, device
+        except Exception as e:
+            print(f"Error loading model: {e}")
+
+    print("Ensure yolov8n.engine or yolov8n.onnx exists.")
+    return None, False, None
 
 def main():
-    print(f"Loading model: {MODEL_PATH}...")
+    global status_shm, wake_fd
+
     try:
-        model = YOLO(MODEL_PATH, task='detect')
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        print("Ensure yolov8n.onnx or yolov8n.pt exists.")
+        status_shm = detection_shm.open_region()
+    except PermissionError as e:
+        # The controller is using this region, falling back to the file would leave it blind
+        print(f"Error: Can't open shared memory '{detection_shm.SHM_NAME}' ({e}).")
+        print(f"Add this user to the {detection_shm.GROUP} group, or remove /dev/shm/{detection_shm.SHM_NAME} if an older version left it behind.")
+        return
+    except OSError as e:
+        print(f"Shared memory unavailable ({e}), falling back to {SHARED_FILE_PATH}")
+    else:
+        try:
+            wake_fd = detection_shm.create_wakeup()
+        except OSError as e:
+            print(f"Controller wakeup unavailable ({e}), controller will poll")
+
+    model, half, device = load_model()
+    if model is None:
         return
 
     # Open webcam
-    cap = cv2.VideoCapture(0)
+    cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
     if not cap.isOpened():
         print("Error: Could not open webcam.")
         return
-
-    cv2.namedWindow("YOLOv8 Detection", cv2.WINDOW_NORMAL)
-    cv2.resizeWindow("YOLOv8 Detection", 1280, 720)
-
-    print("Starting detection loop. Press 'q' to quit.")
+    cap.set(cv2.CAP_PROP_FPS, CAMERA_FPS)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    frame_slot = queue.Queue(maxsize=1)
+    stop = threading.Event()
+    grabber = threading.Thread(target=grab_frames, args=(cap, frame_slot, stop), daemon=True)
+    grabber.start()
+
+    if DISPLAY:
+        cv2.namedWindow("YOLOv8 Detection", cv2.WINDOW_NORMAL)
+        cv2.resizeWindow("YOLOv8 Detection", 1280, 720)
+        print("Starting detection loop. Press 'q' to quit.")
+    else:
+        print("Starting detection loop. Press Ctrl+C to quit.")
+
+    # Inference settings are the same every frame, build them once
+    predict_args = dict(verbose=False, conf=CONFIDENCE_THRESHOLD, classes=VEHICLE_CLASSES,
+                        imgsz=IMG_SIZE, half=half, device=device)
+
+    frame_idx = 0
+    car_detected = False
+    prev_small = None
+    last_infer_time = 0.0
 
     try:
         while True:
-            ret, frame = cap.read()
-            if not ret:
-                print("Failed to grab frame")
+            try:
+                frame = frame_slot.get(timeout=FRAME_TIMEOUT)
+            except queue.Empty:
+                print("No frame from camera")
                 break
 
-            # Run inference
-            results = model(frame, verbose=False, conf=CONFIDENCE_THRESHOLD)
-
-            car_detected = False
-
-            # Check results
-            for result in results:
-                for box in result.boxes:
-                    cls_id = int(box.cls[0])
-                    if cls_id in VEHICLE_CLASSES:
-                        car_detected = True
-                        break # Found at least one car
-
-            # Update the shared file
+            # Compare against the frame inference last ran on, so slow changes still add up
+            small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), DIFF_SIZE,
+                               interpolation=cv2.INTER_AREA).astype(np.int16)
+            now = time.monotonic()
+            if (prev_small is not None and now - last_infer_time < MAX_STALE
+                    and np.abs(small - prev_small).mean() < DIFF_THRESHOLD):
+                # Scene unchanged, republish the last result so the controller sees we're alive
+                write_status(car_detected)
+                continue
+            prev_small = small
+            last_infer_time = now
+
+            # Run inference, non-vehicle boxes are dropped during NMS
+            results = model(frame, **predict_args)
+
+            # Any box left is a vehicle
+            car_detected = len(results[0].boxes) > 0
+
+            # Publish result to the controller
             write_status(car_detected)
 
             # Visualize
-            annotated_frame = results[0].plot()
-            cv2.imshow("YOLOv8 Detection", annotated_frame)
-
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
+            if DISPLAY and frame_idx % SHOW_EVERY == 0:
+                annotated_frame = results[0].plot()
+                cv2.imshow("YOLOv8 Detection", annotated_frame)
 
-            # Small sleep to save resources
-            time.sleep(0.1)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+            frame_idx += 1
 
     except KeyboardInterrupt:
         print("\nStopping...")
     finally:
+        stop.set()
+        grabber.join(timeout=FRAME_TIMEOUT)
         cap.release()
-        cv2.destroyAllWindows()
-        # Clean up file on exit so lights don't get stuck
+        if DISPLAY:
+            cv2.destroyAllWindows()
+        # Clear the flag on exit so lights don't get stuck
         write_status(False)
+        if wake_fd is not None:
+            detection_shm.close_wakeup(wake_fd)
+        if status_shm is not None:
+            status_shm.close()
 
 if __name__ == "__main__":
     main()